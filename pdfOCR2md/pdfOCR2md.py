@@ -6,19 +6,43 @@ License CC-BY-SA
 
 import sys
 import os
+import argparse
+import asyncio
 import base64
+import hashlib
+import json
+import random
 import re
 import datetime
 import platform
+from concurrent.futures import ThreadPoolExecutor
 
-from pdf2image import convert_from_path
-from openai import OpenAI
+import httpx
+import pymupdf
+from openai import AsyncOpenAI, RateLimitError
 
 MODEL = "gpt-4o"
 # MODEL = "gpt-4o-mini"  makes too many OCR errors
 MAX_TOKENS = 4096  # Default output token limit
-
-
+DPI = 200  # Rendering resolution for born-digital (vector) pages
+MIN_DPI = 120  # Floor for scanned pages with a low-resolution embedded raster
+MAX_DPI = 240  # Ceiling; more pixels than this only inflate upload bytes
+IMAGE_FORMAT = "webp"  # Set to "jpeg" if the target model rejects WebP
+IMAGE_QUALITY = 70  # WebP ~halves JPEG size at comparable perceptual quality
+DETAIL_FIRST_PAGE = "high"  # Letterhead and fine print need full tiling
+DETAIL_OTHER_PAGES = "low"  # Continuation pages; set to "high" for table-heavy documents
+
+MAX_CONCURRENCY = 8  # Simultaneous requests in flight
+REQUESTS_PER_MINUTE = 60  # Proactive pacing, keep below the account RPM limit
+MAX_RETRIES = 6  # Attempts per request when rate limited
+PAGES_PER_REQUEST = 4  # Pages packed into one multi-image request
+CACHE_DIR = ".cache"  # Completed conversions, keyed by request content hash
+
+
+# The system and user prompts must stay byte-identical across requests (no
+# .format interpolation): the provider caches the common request prefix, so a
+# stable prefix skips re-tokenizing it on every batch. Anything
+# page-dependent belongs after the prompts in the user content list.
 SYSTEM_PROMPT = """You are an assistant that converts PDF page images to structured Markdown text.
 Follow these rules:
 
@@ -63,11 +87,23 @@ Tables:
 """
 
 
-USER_PROMPT = """Here is the Markdown from the previous page (if empty, this is the first page):
-{}
+USER_PROMPT = """Convert the following page images to Markdown, without adding explanations or comments.
+Each image is preceded by a separator line "--- Page N ---".
+Begin each page's conversion with a line containing exactly `<!-- PDF page N -->`.
+Limit your response to the image content."""
 
-Now, convert the following base64-encoded page to Markdown, without adding explanations or comments.
-Limit your response to the image content, without repeating the text above."""
+PAGE_MARKER = "<!-- PDF page {} -->"
+BLANK_MARKER = "<!-- PDF page {}: blank -->"
+BLANK_INK_RATIO = 0.001  # Ink-pixel fraction below which a page counts as blank
+INK_THRESHOLD = 200  # Grayscale value under which a pixel counts as ink
+THUMBNAIL_DPI = 24  # Resolution of the blank-detection thumbnail
+
+# Response cleanup patterns, compiled once instead of per batch
+FENCE_OPEN_RE = re.compile(r"^```(?:markdown|html)?[ \t]*\n")
+FENCE_CLOSE_RE = re.compile(r"\n```[ \t]*$")
+TABLE_TAG_RE = re.compile(r"^\s*<(tr|td|th)", re.MULTILINE)
+TABLE_INDENT = {"tr": "  <tr", "td": "    <td", "th": "    <th"}
+PAGE_MARKER_RE = re.compile(r"^<!-- PDF page (\d+)", re.MULTILINE)
 
 
 def validate_inputs(pdf_path):
@@ -88,125 +124,327 @@ def get_output_path(pdf_path):
     return output_path
 
 
-def process_model_response(response, page_num, total_pages):
-    """Extract and clean markdown text from model response."""
+def process_model_response(response, first_page, last_page):
+    """Extract and clean markdown text from a batch model response."""
     if not response.choices:
         raise ValueError("Unexpected model response: 'choices' is empty.")
 
     assistant_message = response.choices[0].message
     if not (assistant_message and hasattr(assistant_message, "content")):
-        raise ValueError(f"Unexpected model response for page {page_num + 1}")
+        raise ValueError(
+            f"Unexpected model response for pages {first_page + 1}-{last_page + 1}"
+        )
 
     markdown_text = assistant_message.content
 
     # Remove code block markers
-    markdown_text = re.sub(r"^```(?:markdown|html)?[ \t]*\n", "", markdown_text)
-    markdown_text = re.sub(r"\n```[ \t]*$", "", markdown_text)
+    markdown_text = FENCE_OPEN_RE.sub("", markdown_text)
+    markdown_text = FENCE_CLOSE_RE.sub("", markdown_text)
 
     # Standardize table indentation to 2 spaces
-    markdown_text = re.sub(r"^(\s*)<tr", r"  <tr", markdown_text, flags=re.MULTILINE)
-    markdown_text = re.sub(r"^(\s*)<td", r"    <td", markdown_text, flags=re.MULTILINE)
-    markdown_text = re.sub(r"^(\s*)<th", r"    <th", markdown_text, flags=re.MULTILINE)
+    markdown_text = TABLE_TAG_RE.sub(lambda m: TABLE_INDENT[m.group(1)], markdown_text)
 
     # Strip trailing whitespaces
     markdown_text = "\n".join(line.rstrip() for line in markdown_text.splitlines())
 
-    return f"<!-- PDF page {page_num + 1} -->\n" + markdown_text
+    # The prompt asks for a marker before each page; guard the first one
+    # in case the model skipped it.
+    if not markdown_text.lstrip().startswith("<!-- PDF page"):
+        markdown_text = PAGE_MARKER.format(first_page + 1) + "\n" + markdown_text
+
+    return markdown_text
 
 
-def metadata_comment():
+def metadata_comment(pdf_path):
     """Create conversion metadata comment."""
     return f"""
 
 <!-- Converted from PDF using:
 Command: python {' '.join(sys.argv)}
 Date: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-Source: {os.path.basename(sys.argv[1])}
+Source: {os.path.basename(pdf_path)}
 Platform: {platform.platform()}
 Python: {platform.python_version()}
 Model: {MODEL}
 -->"""
 
 
-def pdf_to_markdown(pdf_path):
-    """Convert PDF to Markdown using GPT Vision API."""
-    validate_inputs(pdf_path)
-
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+class RateLimiter:
+    """Pace request starts to a fixed requests-per-minute budget.
 
-    print("Converting PDF to images...")
-    images = convert_from_path(pdf_path, dpi=300, fmt="jpeg")
+    Proactive throttling beats reacting to 429s: backing off after the
+    provider rejects a burst wastes wall-clock sleeping through penalty
+    windows, while pacing sustains near-peak throughput.
+    """
 
-    markdown_pieces = []
-    previous_page_markdown = ""
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
 
-    for page_num, image in enumerate(images):
-        print(f"Processing {base_name} page {page_num + 1}/{len(images)}...")
+    async def wait(self):
+        """Sleep until the next request slot is available."""
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            delay = max(0.0, self.next_slot - now)
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
 
-        # Save temporary image
-        temp_image_path = f"{base_name}_page_{page_num + 1}.jpeg"
-        image.save(temp_image_path, "JPEG")
 
+async def create_with_backoff(client, limiter, **kwargs):
+    """Call the chat completions API, retrying rate-limit errors with backoff."""
+    for attempt in range(MAX_RETRIES):
+        await limiter.wait()
         try:
-            # Process page
-            with open(temp_image_path, "rb") as image_file:
-                encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
-
-            messages = [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": USER_PROMPT.format(previous_page_markdown),
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{encoded_image}"
-                            },
-                        },
-                    ],
+            return await client.chat.completions.create(**kwargs)
+        except RateLimitError:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            delay = min(60.0, 2**attempt + random.uniform(0, 1))
+            print(f"Rate limited, retrying in {delay:.0f}s...")
+            await asyncio.sleep(delay)
+
+
+def page_dpi(page):
+    """Pick a rendering resolution from the page's own content.
+
+    A scanned page cannot yield more detail than its embedded raster, so
+    match the raster's effective DPI (clamped to MIN_DPI-MAX_DPI);
+    born-digital pages with vector text saturate the model at DPI already.
+    """
+    image_dpi = 0
+    for info in page.get_image_info():
+        x0, _, x1, _ = info["bbox"]
+        if x1 > x0:
+            image_dpi = max(image_dpi, info["width"] * 72 / (x1 - x0))
+    if not image_dpi:
+        return DPI
+    return max(MIN_DPI, min(MAX_DPI, round(image_dpi)))
+
+
+def encode_page(doc, page_num, dpi=None):
+    """Render one page and return it base64-encoded.
+
+    Compressed bytes are a few hundred KB, versus tens of MB per page if
+    the whole document were rasterized upfront.
+    """
+    page = doc.load_page(page_num)
+    pix = page.get_pixmap(dpi=dpi or page_dpi(page))
+    if IMAGE_FORMAT == "webp":
+        image_bytes = pix.pil_tobytes(format="WEBP", quality=IMAGE_QUALITY, method=4)
+    else:
+        image_bytes = pix.tobytes("jpeg", jpg_quality=IMAGE_QUALITY)
+    return base64.b64encode(image_bytes).decode("ascii")
+
+
+def is_blank_page(doc, page_num):
+    """Detect an empty page from the ink ratio of a grayscale thumbnail.
+
+    Scan separators and cover backs carry no text; the thumbnail test
+    costs a few milliseconds and saves the whole vision round-trip.
+    """
+    pix = doc.load_page(page_num).get_pixmap(
+        dpi=THUMBNAIL_DPI, colorspace=pymupdf.csGRAY
+    )
+    ink = sum(1 for value in pix.samples if value < INK_THRESHOLD)
+    return ink / len(pix.samples) < BLANK_INK_RATIO
+
+
+def encode_batch(doc, first_page, last_page, dpi=None):
+    """Render and encode a run of consecutive pages; None marks a blank page."""
+    return [
+        None if is_blank_page(doc, page_num) else encode_page(doc, page_num, dpi)
+        for page_num in range(first_page, last_page + 1)
+    ]
+
+
+def insert_blank_markers(markdown_text, blank_pages):
+    """Merge blank-page markers into batch text, keeping page order."""
+    matches = list(PAGE_MARKER_RE.finditer(markdown_text))
+    sections = []
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(markdown_text)
+        sections.append(
+            (int(match.group(1)), markdown_text[match.start():end].rstrip("\n"))
+        )
+    sections += [(page_num + 1, BLANK_MARKER.format(page_num + 1)) for page_num in blank_pages]
+    sections.sort(key=lambda section: section[0])
+    return "\n".join(text for _, text in sections)
+
+
+def cache_path(messages):
+    """Content-addressed cache location for one batch request.
+
+    The key covers the model and the full message list (prompts, rendered
+    image bytes, detail levels), so any change that could alter the
+    response also changes the key.
+    """
+    key = hashlib.sha256(
+        json.dumps([MODEL, messages], sort_keys=True).encode()
+    ).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+
+async def process_batch(client, semaphore, limiter, render_pool, doc, first_page, base_name, dpi):
+    """Convert a run of consecutive pages with one multi-image API call."""
+    async with semaphore:
+        return await _process_batch(
+            client, limiter, render_pool, doc, first_page, base_name, dpi
+        )
+
+
+async def _process_batch(client, limiter, render_pool, doc, first_page, base_name, dpi):
+    last_page = min(first_page + PAGES_PER_REQUEST, doc.page_count) - 1
+    print(
+        f"Processing {base_name} pages {first_page + 1}-{last_page + 1}"
+        f"/{doc.page_count}..."
+    )
+
+    # Render in the worker thread so the event loop keeps serving API
+    # traffic: the next batch rasterizes while this one awaits its response.
+    encoded_images = await asyncio.get_running_loop().run_in_executor(
+        render_pool, encode_batch, doc, first_page, last_page, dpi
+    )
+
+    blank_pages = []
+    content = [{"type": "text", "text": USER_PROMPT}]
+    for page_num, encoded_image in zip(range(first_page, last_page + 1), encoded_images):
+        if encoded_image is None:
+            blank_pages.append(page_num)
+            continue
+        content.append({"type": "text", "text": f"--- Page {page_num + 1} ---"})
+        content.append(
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/{IMAGE_FORMAT};base64,{encoded_image}",
+                    "detail": DETAIL_FIRST_PAGE if page_num == 0 else DETAIL_OTHER_PAGES,
                 },
+            }
+        )
+
+    if blank_pages:
+        print(f"Skipping blank page(s) {', '.join(str(n + 1) for n in blank_pages)}.")
+    if not any(encoded_images):
+        # Wholly blank batch: nothing to send
+        return "\n".join(BLANK_MARKER.format(n + 1) for n in blank_pages)
+
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": content},
+    ]
+
+    cached = cache_path(messages)
+    if os.path.exists(cached):
+        print(f"Pages {first_page + 1}-{last_page + 1}/{doc.page_count} loaded from cache.")
+        with open(cached, encoding="utf-8") as f:
+            return json.load(f)["markdown"]
+
+    response = await create_with_backoff(
+        client,
+        limiter,
+        model=MODEL,
+        messages=messages,
+        # The output budget scales with the number of pages in the batch.
+        max_tokens=MAX_TOKENS * (last_page - first_page + 1),
+        # Route every batch to the same cache shard so the shared prompt
+        # prefix hits the provider-side prompt cache.
+        prompt_cache_key="pdfOCR2md",
+    )
+
+    markdown_text = process_model_response(response, first_page, last_page)
+    if blank_pages:
+        markdown_text = insert_blank_markers(markdown_text, blank_pages)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cached, "w", encoding="utf-8") as f:
+        json.dump({"markdown": markdown_text}, f, ensure_ascii=False)
+
+    print(f"Pages {first_page + 1}-{last_page + 1}/{doc.page_count} converted successfully.")
+    return markdown_text
+
+
+async def convert_pages(doc, base_name, out, dpi=None):
+    """Convert all pages concurrently, writing batches to `out` in page order.
+
+    Each batch is flushed as soon as it and all batches before it are done,
+    so memory stays bounded and a killed run leaves usable partial output.
+    """
+    # Size the connection pool to the concurrency cap so bursts reuse warm
+    # TLS connections instead of tearing down and re-handshaking.
+    async with httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY
+        )
+    ) as http_client:
+        client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client)
+        semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        limiter = RateLimiter(REQUESTS_PER_MINUTE)
+
+        batch_starts = range(0, doc.page_count, PAGES_PER_REQUEST)
+
+        # One render thread: pymupdf documents are not thread-safe, and a single
+        # thread keeps rasterization ahead of the network without racing it.
+        # The semaphore already bounds how many rendered batches sit in memory.
+        with ThreadPoolExecutor(max_workers=1) as render_pool:
+            tasks = [
+                asyncio.create_task(
+                    process_batch(
+                        client, semaphore, limiter, render_pool, doc, first_page, base_name, dpi
+                    )
+                )
+                for first_page in batch_starts
             ]
 
-            response = client.chat.completions.create(
-                model=MODEL, messages=messages, max_tokens=MAX_TOKENS
-            )
+            for first_page, task in zip(batch_starts, tasks):
+                try:
+                    markdown_text = await task
+                except Exception as e:
+                    last_page = min(first_page + PAGES_PER_REQUEST, doc.page_count)
+                    print(f"Error processing pages {first_page + 1}-{last_page}: {str(e)}")
+                    continue
+                out.write(markdown_text + "\n")
 
-            markdown_text = process_model_response(response, page_num, len(images))
-            markdown_pieces.append(markdown_text)
-            previous_page_markdown = markdown_text
 
-            print(f"Page {page_num + 1}/{len(images)} converted successfully.")
+def pdf_to_markdown(pdf_path, output_path, dpi=None):
+    """Convert PDF to Markdown using GPT Vision API.
 
-        except Exception as e:
-            print(f"Error processing page {page_num + 1}: {str(e)}")
-            continue
-        finally:
-            if os.path.exists(temp_image_path):
-                os.remove(temp_image_path)
+    Pages are converted concurrently in batches of PAGES_PER_REQUEST: each
+    batch is an independent request, so wall-clock time is bounded by the
+    slowest batch instead of the sum, and the system prompt is charged once
+    per batch instead of once per page.
+
+    Each page is rendered at a resolution matched to its content unless
+    `dpi` forces a uniform value.
+    """
+    validate_inputs(pdf_path)
 
-    return "\n".join(markdown_pieces)
+    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+
+    doc = pymupdf.open(pdf_path)
+    try:
+        with open(output_path, "w", encoding="utf-8") as out:
+            asyncio.run(convert_pages(doc, base_name, out, dpi))
+            out.write(metadata_comment(pdf_path))
+    finally:
+        doc.close()
 
 # TODO: keep OCRed page numbers as a comment
 # TODO: Deal with running headers
 # TODO: Merge continued tables. Could be as simple as stripping </table>\n<!-- PDF Page ## -->\n<!-- PageContinues --><table>. Use a string constant for the PageContinues marker.
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python pdfOCR2md.py file.pdf")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Convert a PDF to Markdown with GPT vision")
+    parser.add_argument("pdf_path", help="PDF file to convert")
+    parser.add_argument(
+        "--dpi", type=int, help="Force this rendering DPI for every page"
+    )
+    args = parser.parse_args()
 
     try:
-        pdf_path = sys.argv[1]
-        result = pdf_to_markdown(pdf_path)
-        output_path = get_output_path(pdf_path)
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(result)
-            f.write(metadata_comment())
+        output_path = get_output_path(args.pdf_path)
+        pdf_to_markdown(args.pdf_path, output_path, dpi=args.dpi)
         print(f"Conversion complete: {output_path}")
     except FileNotFoundError as fnfe:
         print(f"Error: {str(fnfe)}")
@@ -11,14 +11,15 @@ Usage:
 """
 
 import argparse
-import json
+import asyncio
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date
 from pathlib import Path
 
+import httpx
+import orjson
 import yaml
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 
 def load_models(path: str) -> list[dict]:
@@ -26,9 +27,9 @@ def load_models(path: str) -> list[dict]:
         return yaml.safe_load(f)
 
 
-def query_model(client: OpenAI, model_id: str, prompt: str) -> dict:
+async def query_model(client: AsyncOpenAI, model_id: str, prompt: str) -> dict:
     """Send prompt to a model via OpenRouter, return response dict."""
-    response = client.chat.completions.create(
+    response = await client.chat.completions.create(
         model=model_id,
         messages=[{"role": "user", "content": prompt}],
     )
@@ -59,8 +60,9 @@ def save_result(output_dir: Path, model_id: str, prompt: str, result: dict):
         **result,
     }
 
-    with open(filepath, "w") as f:
-        json.dump(record, f, indent=2, ensure_ascii=False)
+    # orjson writes UTF-8 bytes directly, skipping stdlib json's
+    # pure-Python encoder and an intermediate str buffer.
+    filepath.write_bytes(orjson.dumps(record, option=orjson.OPT_INDENT_2))
 
     print(f"  Saved {filepath}")
 
@@ -81,18 +83,13 @@ def main():
     if not api_key:
         raise SystemExit("Set OPENROUTER_API_KEY environment variable")
 
-    client = OpenAI(
-        base_url="https://openrouter.ai/api/v1",
-        api_key=api_key,
-    )
-
     # Filter to single model if requested
     if args.model:
         models = [m for m in models if m["id"] == args.model]
         if not models:
             raise SystemExit(f"Model {args.model} not found in {args.models}")
 
-    def query_and_save(model: dict) -> str:
+    async def query_and_save(client: AsyncOpenAI, model: dict) -> str:
         model_id = model["id"]
         label = model.get("name", model_id)
         # Skip if already queried today
@@ -102,7 +99,7 @@ def main():
             return f"  ⏭ {label} (cached)"
         print(f"Querying {label} ({model_id})...")
         try:
-            result = query_model(client, model_id, prompt)
+            result = await query_model(client, model_id, prompt)
             save_result(output_dir, model_id, prompt, result)
             return f"  ✓ {label}"
         except Exception as e:
@@ -115,11 +112,22 @@ def main():
             })
             return f"  ✗ {label}: {e}"
 
-    workers = min(8, len(models))
-    with ThreadPoolExecutor(max_workers=workers) as pool:
-        futures = {pool.submit(query_and_save, m): m for m in models}
-        for future in as_completed(futures):
-            print(future.result())
+    async def run() -> list[str]:
+        # Models live behind independent OpenRouter endpoints, so all of
+        # them can be in flight at once; wall-clock is the slowest model.
+        # One pre-sized connection pool serves every request, so concurrent
+        # dispatch reuses warm TLS connections.
+        limits = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+        async with httpx.AsyncClient(limits=limits) as http_client:
+            client = AsyncOpenAI(
+                base_url="https://openrouter.ai/api/v1",
+                api_key=api_key,
+                http_client=http_client,
+            )
+            return await asyncio.gather(*[query_and_save(client, m) for m in models])
+
+    for line in asyncio.run(run()):
+        print(line)
 
 
 if __name__ == "__main__":